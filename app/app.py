@@ -2,24 +2,61 @@ import serial
 import socket
 from argparse import ArgumentParser
 import logging
-from collections import OrderedDict
+import selectors
 import sys
+from collections import OrderedDict
 import time
 from waggle.plugin import Plugin, get_timestamp
-import os
 
 # Configure logging for the script
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
+logger = logging.getLogger(__name__)
 
-# Timeout duration in seconds
+# A device that sends no complete line for this long is treated as lost, in seconds
 TIMEOUT_SECONDS = 300
 
+# Reconnect backoff after a lost connection, in seconds
+RECONNECT_DELAY_SECONDS = 1
+MAX_RECONNECT_DELAY_SECONDS = 60
+
+class AuthenticationError(Exception):
+    """The TCP device rejected the username or password.
+
+    Deliberately not an OSError, so connect_with_backoff() does not retry
+    bad credentials and the plugin exits instead.
+    """
+
+def make_parser(data_names):
+    """Return a function mapping a raw Sonic3D line to a tuple of floats.
+
+    A record is a status field followed by one field per data name (U;V;W;T),
+    possibly with further fields after them. Values are returned in
+    data_names order. The parser is generated as straight-line code for the
+    number of data names, so no per-line loop or slicing is needed.
+    """
+    count = len(data_names)
+    fields = ", ".join(f"_float(p[{i}])" for i in range(1, count + 1))
+    src = (
+        "def parse(line, _float=float, _warn=logger.warning):\n"
+        # Stop splitting after the last needed field; the rest stays joined
+        f"    p = line.split(b';', {count + 1})\n"
+        f"    if len(p) < {count + 1}:\n"
+        "        _warn('Empty or incomplete data line received.')\n"
+        "        raise ValueError('Empty or incomplete data line.')\n"
+        f"    return ({fields},)\n"
+    )
+    namespace = {"logger": logger}
+    exec(src, namespace)
+    return namespace["parse"]
+
 class DeviceConnection:
     def __init__(self, args):
+        self.args = args  # Kept so a lost connection can be reopened
         self.connection_type = args.connection_type
-        self.buffer = b""  # Initialize buffer for storing received byte strings
+        self.buffer = bytearray()  # Received bytes not yet split into lines
+        self._scan_pos = 0  # Buffer offset already searched for a newline
 
         # Establish connection based on the type specified
         if self.connection_type == "usb":
@@ -31,102 +68,202 @@ class DeviceConnection:
                 parity=serial.PARITY_NONE,
                 stopbits=serial.STOPBITS_ONE,
             )
-            logging.info("Connected to USB-Serial device.")
+            logger.info("Connected to USB-Serial device.")
         elif self.connection_type == "tcp":
             # Set up TCP connection
             self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.connection.connect((args.ip, args.port))
             
             # Authenticate with the TCP device
-            response = self.connection.recv(4096).decode("utf-8")
+            self.connection.recv(4096)
             self.connection.sendall(f"{args.username}\r\n".encode())
-            response = self.connection.recv(4096).decode("utf-8")
+            self.connection.recv(4096)
             self.connection.sendall(f"{args.password}\r\n".encode())
-            
-            response = self.connection.recv(4096).decode("utf-8")
-            if "authentication successful" not in response.lower():
-                raise Exception("Authentication failed.")
-                
-            logging.info("Connected to TCP device.")
+
+            response = self.connection.recv(4096)
+            if b"authentication successful" not in response.lower():
+                self.connection.close()
+                raise AuthenticationError("Authentication failed.")
+
+            logger.info("Connected to TCP device.")
         else:
             raise ValueError("Unsupported connection type.")
     
-    def read_and_parse_data(self, data_names):
-        try:
-            # Read data based on connection type
-            if self.connection_type == "usb":
-                # Read and parse line from USB-Serial connection
-                line = self.connection.readline().decode("utf8").rstrip().split(";")[1:5]
-            elif self.connection_type == "tcp":
-                # Ensure the buffer has a complete line
-                while b"\r\n" not in self.buffer:
-                    self.buffer += self.connection.recv(4096)
-                # Extract the first complete line from the buffer
-                line, self.buffer = self.buffer.split(b"\r\n", 1)
-                line = line.decode("utf-8").rstrip().split(";")[1:5]
-            else:
-                raise ValueError("Unsupported connection type.")
-            
-            # Check for valid data line
-            if not line or len(line) < len(data_names):
-                logging.warning("Empty or incomplete data line received.")
-                raise ValueError("Empty or incomplete data line.")
-            
-            # Map the parsed values to their respective keys
-            keys = data_names.keys()
-            values = [float(value) for value in line]
-            data_dict = dict(zip(keys, values))
-            return data_dict
-        except Exception as e:
-            logging.error(f"Error reading data: {e}")
-            raise
-
-def publish_data(plugin, data, data_names, meta, additional_meta=None):
-    timestamp = get_timestamp()
-
-    if not data:
-        logging.warning("No data to publish.")
-        plugin.publish("status", "NoData", meta={"timestamp": timestamp})
-        return
-
-    # Publish each data item with its metadata
-    for key, value in data.items():
-        if key in data_names:
+    def fileno(self):
+        """File descriptor of the serial port or socket, for selectors."""
+        return self.connection.fileno()
+
+    def _fill(self):
+        # Append whatever the device has sent; blocks only if nothing is pending
+        if self.connection_type == "usb":
+            chunk = self.connection.read(self.connection.in_waiting or 1)
+        else:
+            chunk = self.connection.recv(4096)
+            if not chunk:
+                raise ConnectionError("Connection closed by device.")
+        self.buffer.extend(chunk)
+
+    def _next_line(self):
+        # Return the next complete line without its \n or \r\n terminator,
+        # or None, scanning only bytes that arrived since the last call
+        idx = self.buffer.find(b"\n", self._scan_pos)
+        if idx < 0:
+            self._scan_pos = len(self.buffer)
+            return None
+        end = idx - 1 if idx and self.buffer[idx - 1] == 0x0D else idx
+        line = bytes(self.buffer[:end])
+        del self.buffer[: idx + 1]
+        self._scan_pos = 0
+        return line
+
+    def on_readable(self):
+        """Read the pending bytes and return the complete lines received."""
+        self._fill()
+        lines = []
+        line = self._next_line()
+        while line is not None:
+            lines.append(line)
+            line = self._next_line()
+        return lines
+
+    def close(self):
+        """Close the underlying serial port or socket."""
+        self.connection.close()
+
+class IOMux:
+    """Wait on several DeviceConnections from one thread using a selector.
+
+    A device that delivers no complete line for idle_timeout seconds is
+    reported as failed, so half-open TCP links and silent serial devices
+    get reconnected instead of hanging the read loop.
+    """
+
+    def __init__(self, idle_timeout=None):
+        self.selector = selectors.DefaultSelector()
+        self.idle_timeout = idle_timeout
+        self.last_line_time = {}  # Device -> monotonic time of its last line
+
+    def register(self, device):
+        self.selector.register(device, selectors.EVENT_READ, device)
+        self.last_line_time[device] = time.monotonic()
+
+    def unregister(self, device):
+        self.selector.unregister(device)
+        del self.last_line_time[device]
+
+    def poll(self, timeout=None):
+        """Read every ready device and return (ready, failed).
+
+        ready holds (device, line) pairs for the complete lines received and
+        failed holds (device, error) pairs for devices whose read raised an
+        I/O error or went quiet for longer than idle_timeout, so one lost
+        device does not discard the others' lines.
+        """
+        ready = []
+        failed = []
+        for key, _ in self.selector.select(timeout):
+            device = key.data
             try:
-                # Prepare metadata for publishing
-                meta_data = {
-                    "missing": "-9999.0",
-                    "units": meta["units"][data_names[key]],
-                    "description": meta["description"][data_names[key]],
-                    "name": data_names[key],
-                    "sensor": meta["sensor"],
-                }
-                if additional_meta:
-                    meta_data.update(additional_meta)
-
-                plugin.publish(
-                    data_names[key], value, meta=meta_data, timestamp=timestamp
-                )
-            except KeyError as e:
-                plugin.publish('status', f'{e}')
-                print(f"Error: Missing key in meta data - {e}")
+                lines = device.on_readable()
+            except (OSError, serial.SerialException) as e:
+                failed.append((device, e))
+                continue
+            if lines:
+                self.last_line_time[device] = time.monotonic()
+            for line in lines:
+                ready.append((device, line))
+
+        if self.idle_timeout is not None:
+            now = time.monotonic()
+            failed_devices = [device for device, _ in failed]
+            for device, last_line_time in self.last_line_time.items():
+                if now - last_line_time > self.idle_timeout and device not in failed_devices:
+                    failed.append((
+                        device,
+                        TimeoutError(f"No data received for {self.idle_timeout} s."),
+                    ))
+        return ready, failed
+
+    def close(self):
+        self.selector.close()
+
+def build_meta_cache(data_names, meta):
+    """Build the (publish name, metadata) pairs once, in data_names order."""
+    return tuple(
+        (
+            name,
+            {
+                "missing": "-9999.0",
+                "units": meta["units"][name],
+                "description": meta["description"][name],
+                "name": name,
+                "sensor": meta["sensor"],
+            },
+        )
+        for name in data_names.values()
+    )
+
+def publish_data(plugin, values, meta_cache, timestamp, additional_meta=None):
+    # Merge any extra metadata once per sample, not once per variable
+    if additional_meta:
+        meta_cache = tuple(
+            (name, {**meta_data, **additional_meta})
+            for name, meta_data in meta_cache
+        )
+
+    # Publish each value with its precomputed metadata
+    for (name, meta_data), value in zip(meta_cache, values):
+        plugin.publish(name, value, meta=meta_data, timestamp=timestamp)
+
+def connect_with_backoff(args):
+    """Open a DeviceConnection, retrying with exponential backoff on I/O errors."""
+    delay = RECONNECT_DELAY_SECONDS
+    while True:
+        try:
+            return DeviceConnection(args)
+        except (OSError, serial.SerialException) as e:
+            logger.error(f"Connection failed: {e}, retrying in {delay} s.")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY_SECONDS)
 
 def run_device_interface(args, data_names, meta):
+    meta_cache = build_meta_cache(data_names, meta)
+    parse = make_parser(data_names)
     with Plugin() as plugin:
-        device_connection = DeviceConnection(args)
-        while True:
-            time.sleep(2)  # Introduce delay between data readings
+        mux = IOMux(idle_timeout=TIMEOUT_SECONDS)
+        mux.register(connect_with_backoff(args))
+        # Bind per-line lookups to locals once, outside the read loop
+        _get_timestamp = get_timestamp
+        debug = logger.isEnabledFor(logging.DEBUG)
+        try:
             while True:
-                try:
-                    # Read and publish data continuously
-                    data = device_connection.read_and_parse_data(data_names)
-                    if args.debug:
-                        print(data)
-                    publish_data(plugin, data, data_names, meta)
-                except Exception as e:
-                    logging.error(f"Error: {e} while reading data.")
+                # select() sleeps until a device has data; the 1 s timeout
+                # only lets the idle watchdog run
+                ready, failed = mux.poll(timeout=1.0)
+
+                for device, line in ready:
+                    try:
+                        data = parse(line)
+                    except (ValueError, IndexError) as e:
+                        # Malformed line, skip it
+                        logger.error(f"Error: {e} while reading data.")
+                        plugin.publish('status', f'{e}')
+                        continue
+                    timestamp = _get_timestamp()
+                    if debug:
+                        logger.debug("data=%r", data)
+                    publish_data(plugin, data, meta_cache, timestamp)
+
+                for device, e in failed:
+                    # Lost this device, back off before reconnecting it
+                    logger.error(f"Connection error: {e}, reconnecting.")
                     plugin.publish('status', f'{e}')
-                    continue
+                    mux.unregister(device)
+                    device.close()
+                    time.sleep(RECONNECT_DELAY_SECONDS)
+                    mux.register(connect_with_backoff(device.args))
+        finally:
+            mux.close()
 
 if __name__ == "__main__":
     # Set up argument parser for command line arguments
@@ -140,6 +277,8 @@ if __name__ == "__main__":
     arg_parser.add_argument('--password', type=str, default="METEKGMBH", help='Password for TCP connection')
     arg_parser.add_argument('--debug', action="store_true", help="Run script in debug mode")
     args = arg_parser.parse_args()
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
 
     # Define data names and metadata for the sonic sensor
     sonic_data_names = OrderedDict(
@@ -169,5 +308,7 @@ if __name__ == "__main__":
 
     try:
         run_device_interface(args, sonic_data_names, sonic_meta)
-    except Exception as e:
-        logging.error(f"Error running device interface: {e}")
+    except Exception:
+        # Log the traceback and exit non-zero so the plugin is restarted
+        logger.exception("Error running device interface")
+        sys.exit(1)
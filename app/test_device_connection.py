@@ -1,19 +1,65 @@
+import socket
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
 from collections import OrderedDict
-from itertools import cycle
 
-# Import DeviceConnection from the app module
-from app import DeviceConnection
+# Import the read path from the app module
+from app import (
+    AuthenticationError,
+    DeviceConnection,
+    IOMux,
+    connect_with_backoff,
+    make_parser,
+    run_device_interface,
+)
+
+TEST_STRING = b'010000320000000000000000000000;-0.001;-0.036;0.012;23.602;0.036;1.525;0.036;1.525\r\n'
+EXPECTED_DATA = (-0.001, -0.036, 0.012, 23.602)  # U, V, W, T
+
+DATA_NAMES = OrderedDict(
+    [
+        ("U", "sonic3d.uwind"),
+        ("V", "sonic3d.vwind"),
+        ("W", "sonic3d.wwind"),
+        ("T", "sonic3d.temp"),
+    ]
+)
+
+SONIC_META = {
+    "sensor": "METEK-sonic3D",
+    "units": {name: "m/s" for name in DATA_NAMES.values()},
+    "description": {name: name for name in DATA_NAMES.values()},
+}
+
+
+def make_tcp_connection(mock_socket, data_chunks):
+    # Authenticate, then have recv return data_chunks one per call
+    mock_socket_instance = mock_socket.return_value
+    mock_socket_instance.recv.side_effect = [
+        b"username prompt",  # Username prompt
+        b"password prompt",  # Password prompt
+        b"authentication successful",  # Authentication response
+    ] + data_chunks
+
+    # Create the args object
+    args = MagicMock()
+    args.connection_type = 'tcp'
+    args.ip = 'dummy_ip'
+    args.port = 1234
+    args.username = 'dummy_user'
+    args.password = 'dummy_pass'
+
+    return DeviceConnection(args)
+
 
 class TestDeviceConnection(unittest.TestCase):
 
     @patch('app.serial.Serial')
-    def test_read_and_parse_data_usb(self, mock_serial):
-        # Mock the readline method to return the test string
-        test_string = b'010000320000000000000000000000;-0.001;-0.036;0.012;23.602;0.036;1.525;0.036;1.525\r\n'
+    def test_on_readable_usb(self, mock_serial):
+        # Mock the read method to return the test string
         mock_serial_instance = mock_serial.return_value
-        mock_serial_instance.readline.return_value = test_string
+        mock_serial_instance.in_waiting = len(TEST_STRING)
+        mock_serial_instance.read.return_value = TEST_STRING
 
         # Create the args object
         args = MagicMock()
@@ -21,50 +67,94 @@ class TestDeviceConnection(unittest.TestCase):
         args.device = 'dummy_device'
         args.baud_rate = 9600
 
-        # Instantiate the DeviceConnection
         device_connection = DeviceConnection(args)
 
-        # Define the data names
-        data_names = OrderedDict(
-            [
-                ("U", "sonic3d.uwind"),
-                ("V", "sonic3d.vwind"),
-                ("W", "sonic3d.wwind"),
-                ("T", "sonic3d.temp"),
-            ]
+        # Only the pending bytes are read, and the terminator is removed
+        lines = device_connection.on_readable()
+        mock_serial_instance.read.assert_called_once_with(len(TEST_STRING))
+        self.assertEqual(lines, [TEST_STRING[:-2]])
+        self.assertEqual(make_parser(DATA_NAMES)(lines[0]), EXPECTED_DATA)
+
+    @patch('app.serial.Serial')
+    def test_parse_incomplete_line(self, mock_serial):
+        # A line with fewer than four data fields must be rejected
+        test_string = b'010000320000000000000000000000;-0.001;-0.036\r\n'
+        mock_serial_instance = mock_serial.return_value
+        mock_serial_instance.in_waiting = len(test_string)
+        mock_serial_instance.read.return_value = test_string
+
+        # Create the args object
+        args = MagicMock()
+        args.connection_type = 'usb'
+        args.device = 'dummy_device'
+        args.baud_rate = 9600
+
+        device_connection = DeviceConnection(args)
+        (line,) = device_connection.on_readable()
+
+        with self.assertRaises(ValueError):
+            make_parser(DATA_NAMES)(line)
+
+    @patch('app.socket.socket')
+    def test_on_readable_tcp_line_split_across_chunks(self, mock_socket):
+        device_connection = make_tcp_connection(
+            mock_socket, [TEST_STRING[:40], TEST_STRING[40:]]
+        )
+
+        # No complete line yet
+        self.assertEqual(device_connection.on_readable(), [])
+
+        # The rest of the line completes it
+        lines = device_connection.on_readable()
+        self.assertEqual(lines, [TEST_STRING[:-2]])
+        self.assertEqual(make_parser(DATA_NAMES)(lines[0]), EXPECTED_DATA)
+
+    @patch('app.socket.socket')
+    def test_on_readable_tcp_several_lines_and_partial(self, mock_socket):
+        # Two full lines and the start of a third arrive in one chunk, then
+        # the rest of the third line arrives with a fourth complete line
+        device_connection = make_tcp_connection(
+            mock_socket,
+            [TEST_STRING * 2 + TEST_STRING[:30], TEST_STRING[30:] + TEST_STRING],
         )
 
-        # Call the read_and_parse_data method
-        parsed_data = device_connection.read_and_parse_data(data_names)
+        self.assertEqual(device_connection.on_readable(), [TEST_STRING[:-2]] * 2)
+        self.assertEqual(device_connection.on_readable(), [TEST_STRING[:-2]] * 2)
+
+    @patch('app.socket.socket')
+    def test_on_readable_tcp_closed(self, mock_socket):
+        # An empty read means the device closed the connection
+        device_connection = make_tcp_connection(mock_socket, [b""])
+
+        with self.assertRaises(ConnectionError):
+            device_connection.on_readable()
+
 
-        # Assert the parsed data
-        expected_data = {
-            "U": -0.001,
-            "V": -0.036,
-            "W": 0.012,
-            "T": 23.602
-        }
-        self.assertEqual(parsed_data, expected_data)
+def make_socket_backed_connection(test):
+    # Back a mocked device socket with a real socket pair so select() works;
+    # the pair must be created before socket.socket is patched
+    device_end, sensor_end = socket.socketpair()
+    test.addCleanup(device_end.close)
+    test.addCleanup(sensor_end.close)
 
+    with patch('app.socket.socket') as mock_socket:
+        device_connection = make_tcp_connection(mock_socket, [])
+    mock_socket.return_value.fileno.side_effect = device_end.fileno
+    mock_socket.return_value.recv.side_effect = device_end.recv
+    return device_connection, sensor_end
 
 
+class TestConnectWithBackoff(unittest.TestCase):
+
+    @patch('app.time.sleep')
     @patch('app.socket.socket')
-    def test_read_and_parse_data_tcp(self, mock_socket):
-        # Mock the recv method to return the test string continuously
-        test_string = b'010000320000000000000000000000;-0.001;-0.036;0.012;23.602;0.036;1.525;0.036;1.525\r\n'
-        authentication_response = b"authentication successful"
-        
-        # Create a generator that will continuously return the test string
-        continuous_data = cycle([test_string])
-
-        # Ensure there are enough responses for each recv call
+    def test_authentication_failure_is_not_retried(self, mock_socket, mock_sleep):
         mock_socket_instance = mock_socket.return_value
         mock_socket_instance.recv.side_effect = [
-            b"username prompt",  # Username prompt
-            b"password prompt",  # Password prompt
-            authentication_response,  # Authentication response
-            next(continuous_data)  # Start continuous data stream
-        ] + [next(continuous_data) for _ in range(100)]  # Add more data responses to cover extended testing
+            b"username prompt",
+            b"password prompt",
+            b"authentication failed",
+        ]
 
         # Create the args object
         args = MagicMock()
@@ -72,27 +162,145 @@ class TestDeviceConnection(unittest.TestCase):
         args.ip = 'dummy_ip'
         args.port = 1234
         args.username = 'dummy_user'
-        args.password = 'dummy_pass'
+        args.password = 'wrong_pass'
 
-        # Instantiate the DeviceConnection
-        device_connection = DeviceConnection(args)
+        with self.assertRaises(AuthenticationError):
+            connect_with_backoff(args)
+
+        mock_socket_instance.close.assert_called_once_with()
+        mock_sleep.assert_not_called()
+
+
+class TestIOMux(unittest.TestCase):
+
+    def test_poll_returns_ready_lines(self):
+        device_connection, sensor_end = make_socket_backed_connection(self)
+
+        mux = IOMux()
+        self.addCleanup(mux.close)
+        mux.register(device_connection)
+
+        # Nothing sent yet, so the poll times out empty
+        self.assertEqual(mux.poll(timeout=0), ([], []))
+
+        sensor_end.sendall(TEST_STRING + TEST_STRING[:30])
+        self.assertEqual(mux.poll(timeout=1.0), ([(device_connection, TEST_STRING[:-2])], []))
+
+        sensor_end.sendall(TEST_STRING[30:])
+        self.assertEqual(mux.poll(timeout=1.0), ([(device_connection, TEST_STRING[:-2])], []))
+
+    def test_poll_keeps_lines_when_another_device_fails(self):
+        good_device, good_sensor = make_socket_backed_connection(self)
+        bad_device, bad_sensor = make_socket_backed_connection(self)
+
+        mux = IOMux()
+        self.addCleanup(mux.close)
+        mux.register(good_device)
+        mux.register(bad_device)
+
+        # One device sends a line while the other closes its connection
+        good_sensor.sendall(TEST_STRING)
+        bad_sensor.close()
+
+        ready, failed = mux.poll(timeout=1.0)
+        self.assertEqual(ready, [(good_device, TEST_STRING[:-2])])
+        self.assertEqual(len(failed), 1)
+        self.assertIs(failed[0][0], bad_device)
+        self.assertIsInstance(failed[0][1], ConnectionError)
+
+
+    def test_poll_reports_idle_device(self):
+        device_connection, sensor_end = make_socket_backed_connection(self)
+
+        with patch('app.time.monotonic', return_value=1000.0):
+            mux = IOMux(idle_timeout=300)
+            self.addCleanup(mux.close)
+            mux.register(device_connection)
+
+        # Within the timeout a quiet device is not reported
+        with patch('app.time.monotonic', return_value=1300.0):
+            self.assertEqual(mux.poll(timeout=0), ([], []))
+
+        # A line resets the timer
+        sensor_end.sendall(TEST_STRING)
+        with patch('app.time.monotonic', return_value=1301.0):
+            self.assertEqual(mux.poll(timeout=1.0), ([(device_connection, TEST_STRING[:-2])], []))
+
+        # Past the timeout with no line the device is reported as failed
+        with patch('app.time.monotonic', return_value=1602.0):
+            ready, failed = mux.poll(timeout=0)
+        self.assertEqual(ready, [])
+        self.assertEqual(len(failed), 1)
+        self.assertIs(failed[0][0], device_connection)
+        self.assertIsInstance(failed[0][1], TimeoutError)
+
+
+class TestRunDeviceInterface(unittest.TestCase):
+
+    @patch('app.time.sleep')
+    @patch('app.IOMux')
+    @patch('app.connect_with_backoff')
+    @patch('app.Plugin')
+    def test_reconnects_after_io_error(self, mock_plugin, mock_connect, mock_mux_class, mock_sleep):
+        plugin = mock_plugin.return_value.__enter__.return_value
+        first_device, second_device = MagicMock(), MagicMock()
+        mock_connect.side_effect = [first_device, second_device]
+
+        # The first poll loses the device, the second reads from the new
+        # connection and the third ends the loop
+        mux = mock_mux_class.return_value
+        mux.poll.side_effect = [
+            ([], [(first_device, ConnectionError("Connection closed by device."))]),
+            ([(second_device, TEST_STRING[:-2])], []),
+            KeyboardInterrupt,
+        ]
+        args = MagicMock()
+        with self.assertRaises(KeyboardInterrupt):
+            run_device_interface(args, DATA_NAMES, SONIC_META)
+
+        # The failed device is reopened with its own args and replaces it in the mux
+        self.assertEqual(mock_connect.call_args_list, [call(args), call(first_device.args)])
+        mux.unregister.assert_called_once_with(first_device)
+        first_device.close.assert_called_once_with()
+        self.assertEqual(mux.register.call_args_list, [call(first_device), call(second_device)])
+        second_device.close.assert_not_called()
+
+        # The status is reported and data from the new connection is published
+        plugin.publish.assert_any_call('status', 'Connection closed by device.')
+        published = [
+            (c.args[0], c.args[1]) for c in plugin.publish.call_args_list if c.args[0] != 'status'
+        ]
+        self.assertEqual(published, list(zip(DATA_NAMES.values(), EXPECTED_DATA)))
+        mux.close.assert_called_once_with()
+
+    @patch('app.IOMux')
+    @patch('app.connect_with_backoff')
+    @patch('app.Plugin')
+    def test_publish_error_is_not_a_lost_device(self, mock_plugin, mock_connect, mock_mux_class):
+        plugin = mock_plugin.return_value.__enter__.return_value
+        plugin.publish.side_effect = OSError("publish failed")
+        device = mock_connect.return_value
+        mux = mock_mux_class.return_value
+        mux.poll.return_value = ([(device, TEST_STRING[:-2])], [])
+
+        # The error propagates instead of triggering a reconnect
+        with self.assertRaises(OSError):
+            run_device_interface(MagicMock(), DATA_NAMES, SONIC_META)
+
+        mock_connect.assert_called_once()
+        device.close.assert_not_called()
+        mux.unregister.assert_not_called()
+
+
+class TestMakeParser(unittest.TestCase):
+
+    def test_parse_other_field_counts(self):
+        # The generated parser follows the number of data names
+        line = b'010000320000000000000000000000;-0.001;-0.036;0.012;23.602\r\n'
+
+        parse_two = make_parser(OrderedDict([("U", "sonic3d.uwind"), ("V", "sonic3d.vwind")]))
+        self.assertEqual(parse_two(line), (-0.001, -0.036))
 
-        # Define the data names
-        data_names = OrderedDict([
-            ("U", "sonic3d.uwind"),
-            ("V", "sonic3d.vwind"),
-            ("W", "sonic3d.wwind"),
-            ("T", "sonic3d.temp"),
-        ])
-
-        # Call the read_and_parse_data method
-        parsed_data = device_connection.read_and_parse_data(data_names)
-
-        # Assert the parsed data
-        expected_data = {
-            "U": -0.001,
-            "V": -0.036,
-            "W": 0.012,
-            "T": 23.602
-        }
-        self.assertEqual(parsed_data, expected_data)
\ No newline at end of file
+        parse_five = make_parser(OrderedDict((str(i), str(i)) for i in range(5)))
+        with self.assertRaises(ValueError):
+            parse_five(line)